@@ -1,14 +1,89 @@
 import os
-import json
+import uuid
+import httpx
+import orjson
+import asyncio
+import contextvars
+import hashlib
 import logging
+import threading
 import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from google import genai
 from google.genai import types
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-# Initialize Gemini client
-client = genai.Client(api_key=os.environ.get("GOOGLE_API_KEY"))
+from sqlalchemy import func
+
+from app import app, db
+from models import AIInsightCache, AIJob, DataEntry, Upload
+from upload_stats import ORJSON_OPTIONS, build_upload_stats, dump_upload_stats
+
+# Initialize Gemini client with a pooled HTTP/2 transport so concurrent calls
+# share keep-alive connections instead of paying a TLS handshake each time
+client = genai.Client(
+    api_key=os.environ.get("GOOGLE_API_KEY"),
+    http_options=types.HttpOptions(async_client_args={
+        "http2": True,
+        "limits": httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    }),
+)
+
+# All async Gemini work runs on one long-lived event loop. Pooled connections are
+# bound to the loop that opened them, so a fresh asyncio.run() per request would
+# discard them (and break on reuse).
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name='ai-insights-loop', daemon=True).start()
+
+# Bump when the prompts change so stale cached responses are not reused
+PROMPT_VERSION = 2
+CACHE_TTL = timedelta(hours=24)
+
+# Background workers for AI analysis so requests do not block on Gemini. Job
+# state lives in the AIJob table so polls can reach any app instance.
+AI_JOB_WORKERS = 4
+AI_JOB_TTL = timedelta(minutes=15)
+_job_executor = ThreadPoolExecutor(max_workers=AI_JOB_WORKERS, thread_name_prefix='ai-insights')
+
+# Gemini calls currently running, keyed by cache key, so identical concurrent
+# requests share one call. Thread-safe futures can be awaited from any event loop.
+_in_flight: Dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
+# Cap on columns sent to Gemini so prompt size stays bounded on wide sheets
+MAX_PROMPT_COLUMNS = 50
+
+# Static prompts are kept byte-identical across calls; only the data payload varies
+ANALYSIS_SYSTEM_PROMPT = """You are an expert data analyst. Analyze the provided Excel data and provide intelligent insights.
+Focus on:
+1. Key trends and patterns in the data
+2. Interesting correlations or relationships
+3. Potential anomalies or outliers
+4. Business recommendations based on the data
+5. Suggested visualizations that would be most effective
+
+Respond with actionable insights that would help a business user understand their data better.
+
+The data is given as compact JSON with the file name, total row count, columns, data types,
+the first 5 rows and basic statistics for numeric columns. Respond in JSON with:
+- "total_rows": the total row count
+- "columns_analyzed": the columns you analyzed
+- "key_insights": a list of objects with "title", "description",
+  "insight_type" (one of trend, pattern, anomaly, summary) and "confidence" (0 to 1)
+- "recommendations": a list of recommendation strings"""
+
+CHART_SYSTEM_PROMPT = """You are a data visualization expert. Based on the column names and sample data provided,
+recommend the most effective chart types and axis combinations.
+Consider data types, relationships, and visualization best practices.
+
+Suggest 3-4 effective chart configurations as a JSON list of objects with:
+- "chart_type": one of bar, line, scatter, pie
+- "x_axis": a column name
+- "y_axis": a column name
+- "title": a suggested chart title
+- "reasoning": why this visualization is effective"""
 
 class DataInsight(BaseModel):
     title: str
@@ -22,108 +97,236 @@ class DataSummary(BaseModel):
     key_insights: List[DataInsight]
     recommendations: List[str]
 
-def analyze_data_with_ai(data_entries, upload_filename: str) -> DataSummary:
+# Request configs are built once and reused so every call sends identical
+# system instructions and schema, which Gemini's implicit prefix cache can hit
+ANALYSIS_CONFIG = types.GenerateContentConfig(
+    system_instruction=ANALYSIS_SYSTEM_PROMPT,
+    response_mime_type="application/json",
+    response_schema=DataSummary,
+)
+
+CHART_CONFIG = types.GenerateContentConfig(
+    system_instruction=CHART_SYSTEM_PROMPT,
+    response_mime_type="application/json",
+)
+
+def run_async(coro):
+    """
+    Run a coroutine on the shared event loop and block until it finishes.
+    The caller's context (including the Flask app context) is carried over.
+    """
+    result = Future()
+    
+    def _copy_result(task: asyncio.Task):
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+    
+    def _start(ctx: contextvars.Context):
+        task = _loop.create_task(coro, context=ctx)
+        task.add_done_callback(_copy_result)
+    
+    _loop.call_soon_threadsafe(_start, contextvars.copy_context())
+    return result.result()
+
+async def _run_db_call(func, *args):
+    """
+    Run a blocking database helper on a worker thread so the shared event loop
+    keeps serving other coroutines. The thread pushes its own app context, and
+    with it its own session, rather than sharing the caller's.
+    """
+    def _call():
+        with app.app_context():
+            return func(*args)
+    
+    return await asyncio.to_thread(_call)
+
+def _cache_key(kind: str, payload: Any) -> str:
+    """
+    Hash the prompt inputs into a stable cache key
+    """
+    raw = orjson.dumps(
+        {"kind": kind, "prompt_version": PROMPT_VERSION, "payload": payload},
+        default=str,
+        option=ORJSON_OPTIONS | orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(raw).hexdigest()
+
+def _get_cached_response(cache_key: str) -> Optional[str]:
+    """
+    Return a cached Gemini response if one exists and has not expired
+    """
+    try:
+        entry = AIInsightCache.query.filter_by(cache_key=cache_key).first()
+        if entry and entry.created_at > datetime.utcnow() - CACHE_TTL:
+            return entry.response_json
+    except Exception as e:
+        logging.error(f"AI cache read error: {e}")
+    return None
+
+def _store_cached_response(cache_key: str, response_text: str):
+    """
+    Store a Gemini response, replacing any expired entry for the same key
+    """
+    try:
+        entry = AIInsightCache.query.filter_by(cache_key=cache_key).first()
+        if entry:
+            entry.response_json = response_text
+            entry.created_at = datetime.utcnow()
+        else:
+            db.session.add(AIInsightCache(cache_key=cache_key, response_json=response_text))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"AI cache write error: {e}")
+
+def _compact_json(obj: Any) -> str:
+    """
+    Serialize prompt data without whitespace to keep input tokens down
+    """
+    return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS).decode()
+
+def _limit_columns(columns: List[str]) -> List[str]:
+    """
+    Return the columns to include in a prompt, capped at MAX_PROMPT_COLUMNS
+    """
+    return list(columns[:MAX_PROMPT_COLUMNS])
+
+async def _generate_content_cached(cache_key: str, user_prompt: str,
+                                   config: types.GenerateContentConfig) -> Optional[str]:
+    """
+    Call Gemini unless an identical request has been answered recently
+    """
+    cached = await _run_db_call(_get_cached_response, cache_key)
+    if cached is not None:
+        return cached
+    
+    # Wait for an identical call already in flight instead of starting another
+    with _in_flight_lock:
+        pending = _in_flight.get(cache_key)
+        if pending is None:
+            future = _in_flight[cache_key] = Future()
+    if pending is not None:
+        return await asyncio.wrap_future(pending)
+    
+    try:
+        response_text = await _call_gemini(cache_key, user_prompt, config)
+        future.set_result(response_text)
+        return response_text
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(cache_key, None)
+
+async def _call_gemini(cache_key: str, user_prompt: str,
+                       config: types.GenerateContentConfig) -> Optional[str]:
+    """
+    Send one request to Gemini and cache a usable response
+    """
+    response = await client.aio.models.generate_content(
+        model="gemini-2.5-flash",
+        contents=[
+            types.Content(role="user", parts=[types.Part(text=user_prompt)])
+        ],
+        config=config,
+    )
+    
+    # Only cache responses that parse, so a bad reply is retried next time
+    if response.text:
+        try:
+            orjson.loads(response.text)
+            await _run_db_call(_store_cached_response, cache_key, response.text)
+        except orjson.JSONDecodeError:
+            pass
+    return response.text
+
+def _rows_to_df(rows: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Build a DataFrame from stored row dicts
+    """
+    return pd.DataFrame([row for row in rows if isinstance(row, dict)])
+
+def count_data_entries(upload_id: int) -> int:
+    """
+    Count stored rows for an upload without loading them
+    """
+    return db.session.query(func.count(DataEntry.id)).filter(DataEntry.upload_id == upload_id).scalar()
+
+def load_data_frame(upload_id: int) -> pd.DataFrame:
+    """
+    Stream an upload's rows from the database into a DataFrame,
+    skipping ORM object hydration
+    """
+    query = (db.session.query(DataEntry.data_json)
+             .filter(DataEntry.upload_id == upload_id)
+             .order_by(DataEntry.id)
+             .yield_per(1000))
+    return _rows_to_df([row.data_json for row in query])
+
+def load_upload_stats(upload_id: int) -> Dict[str, Any]:
+    """
+    Return the stats stored at parse time, computing and saving them for
+    uploads parsed before stats were stored
+    """
+    upload = db.session.get(Upload, upload_id)
+    if upload.stats_json:
+        return orjson.loads(upload.stats_json)
+    
+    stats = build_upload_stats(load_data_frame(upload_id))
+    try:
+        upload.stats_json = dump_upload_stats(stats)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Upload stats save error: {e}")
+    return stats
+
+async def analyze_data_with_ai(stats: Dict[str, Any], upload_filename: str) -> DataSummary:
     """
     Analyze uploaded data using Gemini AI to provide intelligent insights
     """
     try:
-        # Convert data entries to DataFrame for analysis
-        data_rows = []
-        for entry in data_entries:
-            try:
-                row_data = json.loads(entry.data_json)
-                data_rows.append(row_data)
-            except json.JSONDecodeError:
-                continue
-        
-        if not data_rows:
+        if not stats["total_rows"]:
             raise ValueError("No valid data found for AI analysis")
         
-        df = pd.DataFrame(data_rows)
-        
         # Prepare data summary for AI analysis
         data_summary = {
             "filename": upload_filename,
-            "total_rows": len(df),
-            "columns": list(df.columns),
-            "data_types": {col: str(df[col].dtype) for col in df.columns},
-            "sample_data": df.head(5).to_dict('records'),
-            "basic_stats": {}
+            "total_rows": stats["total_rows"],
+            "columns": stats["columns"],
+            "data_types": stats["data_types"],
+            "sample_data": stats["sample_data"],
+            "basic_stats": stats["basic_stats"]
         }
         
-        # Add basic statistics for numeric columns
-        numeric_columns = df.select_dtypes(include=['number']).columns
-        for col in numeric_columns:
-            stats = df[col].describe()
-            data_summary["basic_stats"][col] = {
-                "mean": float(stats['mean']) if not pd.isna(stats['mean']) else None,
-                "median": float(df[col].median()) if not pd.isna(df[col].median()) else None,
-                "std": float(stats['std']) if not pd.isna(stats['std']) else None,
-                "min": float(stats['min']) if not pd.isna(stats['min']) else None,
-                "max": float(stats['max']) if not pd.isna(stats['max']) else None
-            }
-        
-        # Create AI prompt for analysis
-        system_prompt = """
-        You are an expert data analyst. Analyze the provided Excel data and provide intelligent insights.
-        Focus on:
-        1. Key trends and patterns in the data
-        2. Interesting correlations or relationships
-        3. Potential anomalies or outliers
-        4. Business recommendations based on the data
-        5. Suggested visualizations that would be most effective
-        
-        Respond with actionable insights that would help a business user understand their data better.
-        """
-        
-        user_prompt = f"""
-        Please analyze this Excel data and provide insights:
-        
-        File: {upload_filename}
-        Total Rows: {data_summary['total_rows']}
-        Columns: {', '.join(data_summary['columns'])}
-        
-        Data Types: {json.dumps(data_summary['data_types'], indent=2)}
-        
-        Sample Data (first 5 rows):
-        {json.dumps(data_summary['sample_data'], indent=2)}
-        
-        Basic Statistics for Numeric Columns:
-        {json.dumps(data_summary['basic_stats'], indent=2)}
+        # Build one compact payload, capping the number of columns sent
+        columns = _limit_columns(data_summary["columns"])
+        payload = {
+            "file": upload_filename,
+            "total_rows": data_summary["total_rows"],
+            "columns": columns,
+            "data_types": {col: data_summary["data_types"][col] for col in columns},
+            "sample_data": [{col: row.get(col) for col in columns} for row in data_summary["sample_data"]],
+            "basic_stats": {col: col_stats for col, col_stats in data_summary["basic_stats"].items() if col in columns},
+        }
+        if len(data_summary["columns"]) > len(columns):
+            payload["omitted_columns"] = len(data_summary["columns"]) - len(columns)
         
-        Please provide insights in JSON format with this structure:
-        {{
-            "total_rows": {data_summary['total_rows']},
-            "columns_analyzed": {json.dumps(data_summary['columns'])},
-            "key_insights": [
-                {{
-                    "title": "Insight Title",
-                    "description": "Detailed description of the insight",
-                    "insight_type": "trend|pattern|anomaly|summary",
-                    "confidence": 0.85
-                }}
-            ],
-            "recommendations": [
-                "Recommendation 1",
-                "Recommendation 2"
-            ]
-        }}
-        """
+        user_prompt = f"Analyze this Excel data and provide insights:\n{_compact_json(payload)}"
         
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Content(role="user", parts=[types.Part(text=user_prompt)])
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                response_mime_type="application/json",
-                response_schema=DataSummary,
-            ),
+        response_text = await _generate_content_cached(
+            _cache_key("analysis", data_summary),
+            user_prompt,
+            ANALYSIS_CONFIG,
         )
         
-        if response.text:
-            analysis_result = json.loads(response.text)
+        if response_text:
+            analysis_result = orjson.loads(response_text)
             return DataSummary(**analysis_result)
         else:
             raise ValueError("Empty response from AI model")
@@ -132,7 +335,7 @@ def analyze_data_with_ai(data_entries, upload_filename: str) -> DataSummary:
         logging.error(f"AI analysis error: {e}")
         # Return fallback analysis
         return DataSummary(
-            total_rows=len(data_entries),
+            total_rows=stats.get("total_rows", 0),
             columns_analyzed=[],
             key_insights=[
                 DataInsight(
@@ -145,48 +348,27 @@ def analyze_data_with_ai(data_entries, upload_filename: str) -> DataSummary:
             recommendations=["Please check your data format and try again."]
         )
 
-def generate_chart_recommendations(columns: List[str], sample_data: List[Dict]) -> List[Dict[str, str]]:
+async def generate_chart_recommendations(columns: List[str], sample_data: List[Dict]) -> List[Dict[str, str]]:
     """
     Use AI to recommend the best chart types for the data
     """
     try:
-        system_prompt = """
-        You are a data visualization expert. Based on the column names and sample data provided,
-        recommend the most effective chart types and axis combinations.
-        Consider data types, relationships, and visualization best practices.
-        """
-        
-        user_prompt = f"""
-        Based on these columns and sample data, recommend the best chart configurations:
-        
-        Columns: {', '.join(columns)}
-        Sample Data: {json.dumps(sample_data[:3], indent=2)}
+        prompt_columns = _limit_columns(columns)
+        payload = {
+            "columns": prompt_columns,
+            "sample_data": [{col: row.get(col) for col in prompt_columns} for row in sample_data[:3]],
+        }
         
-        Please suggest 3-4 effective chart configurations in JSON format:
-        [
-            {{
-                "chart_type": "bar|line|scatter|pie",
-                "x_axis": "column_name",
-                "y_axis": "column_name", 
-                "title": "Suggested Chart Title",
-                "reasoning": "Why this visualization is effective"
-            }}
-        ]
-        """
+        user_prompt = f"Recommend the best chart configurations for this data:\n{_compact_json(payload)}"
         
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Content(role="user", parts=[types.Part(text=user_prompt)])
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                response_mime_type="application/json",
-            ),
+        response_text = await _generate_content_cached(
+            _cache_key("chart_recommendations", payload),
+            user_prompt,
+            CHART_CONFIG,
         )
         
-        if response.text:
-            return json.loads(response.text)
+        if response_text:
+            return orjson.loads(response_text)
         else:
             return []
             
@@ -194,52 +376,119 @@ def generate_chart_recommendations(columns: List[str], sample_data: List[Dict])
         logging.error(f"Chart recommendation error: {e}")
         return []
 
-def get_data_quality_insights(data_entries) -> Dict[str, Any]:
+def get_data_quality_insights(stats: Dict[str, Any]) -> Dict[str, Any]:
     """
     Analyze data quality and provide insights
     """
     try:
-        data_rows = []
-        for entry in data_entries:
-            try:
-                row_data = json.loads(entry.data_json)
-                data_rows.append(row_data)
-            except json.JSONDecodeError:
-                continue
+        total_rows = stats["total_rows"]
+        columns = stats["columns"]
         
-        if not data_rows:
+        if not total_rows:
             return {"error": "No valid data found"}
         
-        df = pd.DataFrame(data_rows)
-        
+        missing = stats["missing"]
         quality_report = {
-            "total_rows": len(df),
-            "total_columns": len(df.columns),
-            "missing_data": {},
-            "data_types": {},
-            "unique_values": {},
+            "total_rows": total_rows,
+            "total_columns": len(columns),
+            "missing_data": {
+                col: {"count": missing[col], "percentage": round(missing[col] / total_rows * 100, 2)}
+                for col in columns
+            },
+            "data_types": stats["data_types"],
+            "unique_values": stats["nunique"],
             "quality_score": 0.0
         }
         
-        for col in df.columns:
-            missing_count = df[col].isnull().sum()
-            missing_percentage = (missing_count / len(df)) * 100
-            
-            quality_report["missing_data"][col] = {
-                "count": int(missing_count),
-                "percentage": round(missing_percentage, 2)
-            }
-            
-            quality_report["data_types"][col] = str(df[col].dtype)
-            quality_report["unique_values"][col] = int(df[col].nunique())
-        
         # Calculate overall quality score
-        total_missing = sum(info["percentage"] for info in quality_report["missing_data"].values())
-        avg_missing = total_missing / len(df.columns) if len(df.columns) > 0 else 0
+        total_cells = total_rows * len(columns)
+        avg_missing = sum(missing.values()) / total_cells * 100 if total_cells > 0 else 0
         quality_report["quality_score"] = max(0, 100 - avg_missing)
         
         return quality_report
         
     except Exception as e:
         logging.error(f"Data quality analysis error: {e}")
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+def _run_ai_analysis(upload_id: int, upload_filename: str) -> Dict[str, Any]:
+    """
+    Background job body: run both analyses and return JSON-serializable results.
+    Stats loading and the quality report are synchronous, so they run here on the
+    worker thread and only the Gemini call goes to the shared event loop.
+    """
+    with app.app_context():
+        stats = load_upload_stats(upload_id)
+        quality_report = get_data_quality_insights(stats)
+        ai_analysis = run_async(analyze_data_with_ai(stats, upload_filename))
+        return {
+            "ai_analysis": ai_analysis.model_dump(),
+            "quality_report": quality_report,
+        }
+
+def _run_ai_job(job_id: str, upload_id: int, upload_filename: str):
+    """
+    Run an analysis job and record its outcome on the AIJob row
+    """
+    try:
+        result = _run_ai_analysis(upload_id, upload_filename)
+        status, result_json, error = "done", orjson.dumps(result, default=str, option=ORJSON_OPTIONS).decode(), None
+    except Exception as e:
+        logging.error(f"AI job {job_id} error: {e}")
+        status, result_json, error = "error", None, str(e)
+    
+    with app.app_context():
+        try:
+            job = db.session.get(AIJob, job_id)
+            if job:
+                job.status = status
+                job.result_json = result_json
+                job.error = error
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"AI job {job_id} save error: {e}")
+
+def enqueue_ai_analysis(upload_id: int, upload_filename: str, user_id: int) -> str:
+    """
+    Start AI analysis for an upload in the background and return its job id
+    """
+    # Drop jobs whose results were never collected
+    AIJob.query.filter(AIJob.created_at < datetime.utcnow() - AI_JOB_TTL).delete()
+    
+    job_id = uuid.uuid4().hex
+    db.session.add(AIJob(id=job_id, upload_id=upload_id, user_id=user_id))
+    db.session.commit()
+    
+    _job_executor.submit(_run_ai_job, job_id, upload_id, upload_filename)
+    return job_id
+
+def get_ai_job_status(job_id: str, user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Return the status of a job owned by the user, or None if it is unknown
+    """
+    job = AIJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if not job:
+        return None
+    
+    if job.status == "pending":
+        # The instance running it may have been stopped; report that instead of polling forever
+        if job.created_at < datetime.utcnow() - AI_JOB_TTL:
+            return {"status": "error", "upload_id": job.upload_id, "error": "AI analysis timed out"}
+        return {"status": "pending", "upload_id": job.upload_id}
+    
+    if job.status == "error":
+        return {"status": "error", "upload_id": job.upload_id, "error": job.error}
+    return {"status": "done", "upload_id": job.upload_id, "result": orjson.loads(job.result_json)}
+
+def pop_ai_job_result(job_id: str, user_id: int, upload_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Return and forget the result of a finished job for this user and upload
+    """
+    status = get_ai_job_status(job_id, user_id)
+    if not status or status["upload_id"] != upload_id or status["status"] == "pending":
+        return None
+    
+    AIJob.query.filter_by(id=job_id).delete()
+    db.session.commit()
+    return status
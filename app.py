@@ -1,4 +1,5 @@
 import os
+import orjson
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -24,6 +25,10 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:/
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
+    "insertmanyvalues_page_size": 10000,  # Rows per multi-VALUES INSERT for bulk inserts
+    # orjson for JSON/JSONB columns such as DataEntry.data_json
+    "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+    "json_deserializer": orjson.loads,
 }
 
 # Configure upload settings
@@ -50,9 +55,15 @@ with app.app_context():
     # Import models to ensure tables are created
     import models
     import routes
+    import utils
+    import migrations
     
-    # Create all database tables
+    # Register template helpers
+    utils.init_app(app)
+    
+    # Create all database tables, then upgrade tables from earlier versions
     db.create_all()
+    migrations.upgrade_schema()
     
     # Create upload directory if it doesn't exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
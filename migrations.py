@@ -0,0 +1,70 @@
+import orjson
+import logging
+import pandas as pd
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects.postgresql import JSONB
+from app import db
+from upload_stats import build_upload_stats, dump_upload_stats
+
+# Key for the PostgreSQL advisory lock that lets one instance upgrade at a time
+SCHEMA_LOCK_KEY = 0x4578656C696F
+
+# Columns added to tables that existing databases already have: (table, column, type)
+ADDED_COLUMNS = (
+    ('upload', 'content_sha256', 'VARCHAR(64)'),
+    ('upload', 'stats_json', 'TEXT'),
+    ('upload', 'column_stats', 'TEXT'),
+)
+
+# Indexes superseded by ones declared on the models
+DROPPED_INDEXES = ('ix_dataentry_upload',)
+
+def upgrade_schema():
+    """Bring an existing database up to the current models. db.create_all only
+    creates missing tables, so new columns, indexes and column type changes on
+    existing tables are applied here. Every step checks first, so this is safe
+    to run on each startup."""
+    with db.engine.begin() as conn:
+        postgresql = conn.dialect.name == 'postgresql'
+        if postgresql:
+            # Instances starting together wait here, then find nothing left to do
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+        inspector = inspect(conn)
+        
+        for table, column, column_type in ADDED_COLUMNS:
+            if column not in {col['name'] for col in inspector.get_columns(table)}:
+                logging.info(f"Adding column {table}.{column}")
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+        
+        for name in DROPPED_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        
+        if postgresql:
+            data_json = next(col for col in inspector.get_columns('data_entry') if col['name'] == 'data_json')
+            if not isinstance(data_json['type'], JSONB):
+                _backfill_upload_stats(conn)
+                logging.info("Converting data_entry.data_json to jsonb")
+                conn.execute(text('ALTER TABLE data_entry ALTER COLUMN data_json TYPE jsonb USING data_json::jsonb'))
+
+def _backfill_upload_stats(conn):
+    """Store stats for parsed uploads that have none while their rows still keep
+    key order; JSONB does not, and stats_json is where column order comes from"""
+    upload_ids = conn.execute(text(
+        'SELECT id FROM upload WHERE parsed AND stats_json IS NULL'
+    )).scalars().all()
+    
+    for upload_id in upload_ids:
+        rows = conn.execute(text(
+            'SELECT data_json FROM data_entry WHERE upload_id = :upload_id ORDER BY id'
+        ), {'upload_id': upload_id}).scalars()
+        # TEXT columns come back as strings, json ones already decoded
+        rows = [orjson.loads(row) if isinstance(row, str) else row for row in rows]
+        df = pd.DataFrame([row for row in rows if isinstance(row, dict)])
+        if df.empty:
+            continue
+        
+        conn.execute(text('UPDATE upload SET stats_json = :stats_json WHERE id = :upload_id'),
+                     {'stats_json': dump_upload_stats(build_upload_stats(df)), 'upload_id': upload_id})
@@ -1,7 +1,12 @@
 from datetime import datetime
+from sqlalchemy.dialects.postgresql import JSONB
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
+
+_password_hasher = PasswordHasher()
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,43 +20,99 @@ class User(UserMixin, db.Model):
     uploads = db.relationship('Upload', backref='user', lazy=True, cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password, upgrading legacy or outdated hashes in place.
+        
+        The caller must commit the session for an upgraded hash to persist.
+        """
+        if not self.password_hash.startswith('$argon2'):
+            # Legacy werkzeug PBKDF2/scrypt hash
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        
+        try:
+            _password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        
+        if _password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     def __repr__(self):
         return f'<User {self.username}>'
 
 class Upload(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
     file_size = db.Column(db.Integer)  # Size in bytes
+    content_sha256 = db.Column(db.String(64), index=True)  # Hash of the file contents, for dedup
     parsed = db.Column(db.Boolean, default=False)
     parse_error = db.Column(db.Text)
+    # Parse-time stats, deferred so listing and ownership queries don't fetch them
+    stats_json = db.deferred(db.Column(db.Text))  # Column stats computed at parse time, for AI insights
+    column_stats = db.deferred(db.Column(db.Text))  # Per-column type counts over the first rows, for chart auto-selection
     
     # Relationship with data entries
     data_entries = db.relationship('DataEntry', backref='upload', lazy=True, cascade='all, delete-orphan')
+    sheets = db.relationship('SheetData', backref='upload', lazy=True, cascade='all, delete-orphan')
+    ai_jobs = db.relationship('AIJob', backref='upload', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Upload {self.original_filename}>'
 
 class DataEntry(db.Model):
+    __table_args__ = (
+        db.Index('ix_dataentry_upload_row', 'upload_id', 'row_index'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=False)
     sheet_name = db.Column(db.String(255))
     row_index = db.Column(db.Integer)
-    data_json = db.Column(db.Text)  # JSON string of row data
+    data_json = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'))  # Row data; JSONB on PostgreSQL
+    
+    @classmethod
+    def bulk_create(cls, session, upload_id, rows, sheet_name=None, start_index=0):
+        """Insert many rows in one executemany round-trip.
+        
+        Rows are dicts of cell values. Nothing is committed here, so callers
+        control the surrounding transaction.
+        """
+        session.bulk_insert_mappings(cls, [
+            {
+                "upload_id": upload_id,
+                "sheet_name": sheet_name,
+                "row_index": i,
+                "data_json": row,
+            }
+            for i, row in enumerate(rows, start=start_index)
+        ])
     
     def __repr__(self):
         return f'<DataEntry {self.id}>'
 
+class SheetData(db.Model):
+    """Columnar (Parquet) copy of one parsed sheet, so chart queries can read
+    only the columns they plot instead of every DataEntry row"""
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=False, index=True)
+    sheet_name = db.Column(db.String(255))
+    data_parquet = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f'<SheetData {self.sheet_name}>'
+
 class Chart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=False)
+    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     chart_type = db.Column(db.String(50), nullable=False)  # 'bar', 'line', 'scatter', 'pie'
     x_axis = db.Column(db.String(255))
@@ -61,3 +122,26 @@ class Chart(db.Model):
     
     def __repr__(self):
         return f'<Chart {self.chart_type}>'
+
+class AIInsightCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False, index=True)  # SHA-256 of the prompt inputs
+    response_json = db.Column(db.Text, nullable=False)  # Raw JSON response from Gemini
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AIInsightCache {self.cache_key[:12]}>'
+
+class AIJob(db.Model):
+    """Background AI analysis job, stored in the database so any app instance
+    can answer status polls and serve the result"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # 'pending', 'done', 'error'
+    result_json = db.Column(db.Text)  # Serialized analysis and quality report when done
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<AIJob {self.id} {self.status}>'
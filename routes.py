@@ -1,17 +1,20 @@
 import os
-import json
 import pandas as pd
 from datetime import datetime
 from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy import func, cast, Integer
 import logging
 
 from app import app, db
 from models import User, Upload, DataEntry, Chart
-from utils import allowed_file, parse_excel_file, generate_chart_data
-from ai_insights import analyze_data_with_ai, generate_chart_recommendations, get_data_quality_insights
+from utils import allowed_file, save_upload_stream, parse_excel_file, generate_chart_data, upload_columns, order_columns
+from ai_insights import (DataSummary, run_async, generate_chart_recommendations, count_data_entries,
+                         enqueue_ai_analysis, get_ai_job_status, pop_ai_job_result)
+
+DASHBOARD_PAGE_SIZE = 25  # Uploads per page in the dashboard history
 
 @app.route('/')
 def index():
@@ -80,6 +83,9 @@ def login():
         user = User.query.filter_by(username=username).first()
         
         if user and user.check_password(password):
+            # Persist the hash if check_password upgraded it
+            if db.session.is_modified(user):
+                db.session.commit()
             login_user(user, remember=remember)
             next_page = request.args.get('next')
             flash(f'Welcome back, {user.username}!', 'success')
@@ -101,15 +107,26 @@ def logout():
 @login_required
 def dashboard():
     """User dashboard with upload history"""
-    uploads = Upload.query.filter_by(user_id=current_user.id).order_by(Upload.upload_time.desc()).all()
+    # Calculate statistics in a single aggregate query
+    total_uploads, total_size, successful_uploads = db.session.query(
+        func.count(Upload.id),
+        func.coalesce(func.sum(Upload.file_size), 0),
+        func.coalesce(func.sum(cast(Upload.parsed, Integer)), 0)
+    ).filter(Upload.user_id == current_user.id).one()
     
-    # Calculate statistics
-    total_uploads = len(uploads)
-    successful_uploads = len([u for u in uploads if u.parsed])
-    total_size = sum(u.file_size or 0 for u in uploads)
+    # Only load the current page of the upload history, clamping out-of-range
+    # pages to the last one so the list and its navigation still render
+    last_page = max(1, -(-total_uploads // DASHBOARD_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), last_page)
+    pagination = Upload.query.filter_by(user_id=current_user.id).order_by(Upload.upload_time.desc()).paginate(
+        page=page,
+        per_page=DASHBOARD_PAGE_SIZE,
+        error_out=False
+    )
     
     return render_template('dashboard.html', 
-                         uploads=uploads,
+                         uploads=pagination.items,
+                         pagination=pagination,
                          total_uploads=total_uploads,
                          successful_uploads=successful_uploads,
                          total_size=total_size)
@@ -141,15 +158,24 @@ def upload_file():
             unique_filename = timestamp + filename
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
             
-            file.save(filepath)
-            file_size = os.path.getsize(filepath)
+            # Write and hash the file in a single pass
+            file_size, content_sha256 = save_upload_stream(file.stream, filepath)
+            
+            # Reuse an earlier parsed upload of the same content instead of parsing again
+            existing = Upload.query.filter_by(user_id=current_user.id, content_sha256=content_sha256,
+                                              parsed=True).first()
+            if existing:
+                os.remove(filepath)
+                flash('This file has already been uploaded. Showing the existing data.', 'info')
+                return redirect(url_for('view_data', upload_id=existing.id))
             
             # Create upload record
             upload = Upload(
                 user_id=current_user.id,
                 filename=unique_filename,
                 original_filename=filename,
-                file_size=file_size
+                file_size=file_size,
+                content_sha256=content_sha256
             )
             
             db.session.add(upload)
@@ -197,28 +223,26 @@ def view_data(upload_id):
         flash('This file has not been parsed successfully.', 'warning')
         return redirect(url_for('dashboard'))
     
-    # Get data entries
-    data_entries = DataEntry.query.filter_by(upload_id=upload_id).limit(100).all()
+    # Fetch only the row data of the first 10 rows for the preview
+    rows = db.session.query(DataEntry.data_json).filter_by(upload_id=upload_id).order_by(DataEntry.id).limit(10).all()
     
-    if not data_entries:
+    if not rows:
         flash('No data found in this upload.', 'warning')
         return redirect(url_for('dashboard'))
     
-    # Parse first few rows for preview
     preview_data = []
     columns = []
     
-    for entry in data_entries[:10]:  # Show first 10 rows
-        try:
-            row_data = json.loads(entry.data_json)
-            preview_data.append(row_data)
-            if not columns and isinstance(row_data, dict):
-                columns = list(row_data.keys())
-        except json.JSONDecodeError:
+    for (row_data,) in rows:
+        if not isinstance(row_data, dict):
             continue
+        preview_data.append(row_data)
+        if not columns:
+            # Take the order from parse-time stats, since JSONB reorders object keys
+            columns = order_columns(row_data.keys(), upload_columns(upload_id))
     
     # Generate AI chart recommendations
-    chart_recommendations = generate_chart_recommendations(columns, preview_data)
+    chart_recommendations = run_async(generate_chart_recommendations(columns, preview_data))
     
     return render_template('visualize.html', 
                          upload=upload,
@@ -351,29 +375,38 @@ def ai_insights(upload_id):
         flash('This file has not been parsed successfully.', 'warning')
         return redirect(url_for('dashboard'))
     
-    # Get all data entries for AI analysis
-    data_entries = DataEntry.query.filter_by(upload_id=upload_id).all()
-    
-    if not data_entries:
+    if not count_data_entries(upload_id):
         flash('No data found in this upload.', 'warning')
         return redirect(url_for('dashboard'))
     
-    try:
-        # Get AI insights
-        ai_analysis = analyze_data_with_ai(data_entries, upload.original_filename)
-        
-        # Get data quality insights
-        quality_report = get_data_quality_insights(data_entries)
-        
-        return render_template('ai_insights.html',
-                             upload=upload,
-                             ai_analysis=ai_analysis,
-                             quality_report=quality_report)
-                             
-    except Exception as e:
-        logging.error(f"AI insights error: {e}")
-        flash('Unable to generate AI insights at this time.', 'warning')
-        return redirect(url_for('view_data', upload_id=upload_id))
+    # Render finished results when returning from the polling page
+    job_id = request.args.get('job')
+    if job_id:
+        job = pop_ai_job_result(job_id, current_user.id, upload_id)
+        if job and job['status'] == 'done':
+            return render_template('ai_insights.html',
+                                 upload=upload,
+                                 ai_analysis=DataSummary.model_validate(job['result']['ai_analysis']),
+                                 quality_report=job['result']['quality_report'])
+        if job and job['status'] == 'error':
+            logging.error(f"AI insights error: {job['error']}")
+            flash('Unable to generate AI insights at this time.', 'warning')
+            return redirect(url_for('view_data', upload_id=upload_id))
+    
+    # Run the analysis in the background and let the page poll for it
+    job_id = enqueue_ai_analysis(upload_id, upload.original_filename, current_user.id)
+    return render_template('ai_insights.html', upload=upload, job_id=job_id), 202
+
+@app.route('/ai-insights/status/<job_id>')
+@login_required
+def ai_insights_status(job_id):
+    """API endpoint to poll a background AI analysis job"""
+    job = get_ai_job_status(job_id, current_user.id)
+    
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job)
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -0,0 +1,83 @@
+import orjson
+import pandas as pd
+from typing import List, Dict, Any
+
+# Stats can carry numpy scalars and non-string keys from pandas
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def build_upload_stats(df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    Compute everything the AI analysis and quality report need from an upload's
+    rows, so it can be stored once at parse time instead of recomputed per visit
+    """
+    stats = {
+        "total_rows": len(df),
+        "columns": list(df.columns),
+        "data_types": df.dtypes.astype(str).to_dict(),
+        "sample_data": df.head(5).to_dict('records'),
+        "basic_stats": {},
+        # One vectorized pass per metric instead of one per column
+        "missing": {col: int(n) for col, n in df.isnull().sum().items()},
+        "nunique": {col: int(n) for col, n in df.nunique().items()},
+    }
+    
+    # Add basic statistics for numeric columns in one describe() pass
+    numeric_df = df.select_dtypes(include=['number'])
+    if len(numeric_df.columns) > 0:
+        numeric_stats = numeric_df.describe().T
+        numeric_stats['median'] = numeric_df.median()
+        numeric_stats = numeric_stats[['mean', 'median', 'std', 'min', 'max']].astype(float)
+        numeric_stats = numeric_stats.astype(object).where(numeric_stats.notna(), None)
+        stats["basic_stats"] = numeric_stats.to_dict('index')
+    
+    return stats
+
+class UploadStatsBuilder:
+    """
+    Accumulate upload stats one sheet at a time so parsing never has to hold
+    every sheet in memory. result() matches build_upload_stats on the combined
+    rows; only per-column distinct values are kept across sheets.
+    """
+    def __init__(self):
+        self.total_rows = 0
+        self.data_types: Dict[str, str] = {}  # Column order follows first appearance
+        self.non_null: Dict[str, int] = {}
+        self.distinct: Dict[str, set] = {}
+        self.sample_data: List[Dict[str, Any]] = []
+    
+    def add(self, df: pd.DataFrame):
+        """
+        Fold one sheet's rows into the stats
+        """
+        for col, dtype in df.dtypes.astype(str).items():
+            # Like pd.concat, a column keeps its dtype only if every sheet agrees
+            seen = self.data_types.get(col)
+            self.data_types[col] = dtype if seen in (None, dtype) else "object"
+        for col, count in df.notna().sum().items():
+            self.non_null[col] = self.non_null.get(col, 0) + int(count)
+        for col, series in df.items():
+            self.distinct.setdefault(col, set()).update(series.dropna().unique())
+        
+        if len(self.sample_data) < 5:
+            self.sample_data.extend(df.head(5 - len(self.sample_data)).to_dict('records'))
+        self.total_rows += len(df)
+    
+    def result(self) -> Dict[str, Any]:
+        columns = list(self.data_types)
+        return {
+            "total_rows": self.total_rows,
+            "columns": columns,
+            "data_types": dict(self.data_types),
+            "sample_data": [{col: row.get(col) for col in columns} for row in self.sample_data],
+            # Parsed cells are stored as strings, so there are no numeric columns to describe
+            "basic_stats": {},
+            # Rows from sheets without a column count as missing for it
+            "missing": {col: self.total_rows - self.non_null[col] for col in columns},
+            "nunique": {col: len(self.distinct[col]) for col in columns},
+        }
+
+def dump_upload_stats(stats: Dict[str, Any]) -> str:
+    """
+    Serialize upload stats for Upload.stats_json
+    """
+    return orjson.dumps(stats, default=str, option=ORJSON_OPTIONS).decode()
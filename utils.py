@@ -1,92 +1,426 @@
+import io
 import os
-import json
+import csv
+import orjson
+import hashlib
+import sys
+from decimal import Decimal
+from functools import lru_cache
+from itertools import groupby
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import logging
+from sqlalchemy import Float, Numeric, case, cast, func, literal, type_coerce
+from sqlalchemy.dialects.postgresql import JSONB
 from app import db
-from models import DataEntry
+from models import DataEntry, SheetData, Upload
+from upload_stats import UploadStatsBuilder, dump_upload_stats
 
 ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+INSERT_BATCH_SIZE = 5000  # DataEntry rows per bulk insert
+COPY_THRESHOLD = 5000  # Sheets at least this large are loaded with COPY on PostgreSQL via psycopg2
+COLUMN_SAMPLE_ROWS = 20  # Rows sampled for chart column auto-selection
+PARSE_WORKERS = 4  # Threads converting sheets in parallel
+SHEET_CACHE_SIZE = 8  # Uploads whose decoded sheets are kept in memory for charts
+SCATTER_POINT_LIMIT = 10000  # Points sent to the browser for a scatter chart
+# Modern color palette for pie slices
+MODERN_COLORS = (
+    '#6366F1', '#8B5CF6', '#EC4899', '#EF4444', '#F97316',
+    '#F59E0B', '#10B981', '#06B6D4', '#3B82F6', '#6B7280',
+    '#84CC16', '#F43F5E', '#8B5A2B', '#6366F1', '#14B8A6'
+)
+# Darker shades (80% of each channel) for slice borders
+BORDER_COLORS = tuple(
+    '#' + ''.join(f'{int(int(color[i:i + 2], 16) * 0.8):02X}' for i in (1, 3, 5))
+    for color in MODERN_COLORS
+)
+# Numbers the SQL chart path accepts. Exponents are capped at four digits so
+# the numeric cast cannot overflow; values outside the float8 range are then
+# filtered out, as the Python path drops infinities, and tiny values become 0.
+SQL_NUMERIC_PATTERN = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d{1,4})?\s*$'
+SQL_FLOAT_MAX = Decimal(repr(sys.float_info.max))
+SQL_FLOAT_MIN = Decimal(repr(sys.float_info.min))
 
 def allowed_file(filename):
     """Check if file has allowed extension"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def parse_excel_file(filepath, upload_id):
-    """Parse Excel file and store data in database"""
+def save_upload_stream(stream, filepath):
+    """Write an uploaded file to disk in chunks, returning its size and SHA-256"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filepath, 'wb') as f:
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return size, sha256.hexdigest()
+
+def _sheet_records(df):
+    """Convert a sheet to row dicts column by column: None for missing cells,
+    ISO strings for timestamps and str() for everything else"""
+    na_mask = df.isna().to_numpy()
+    columns = []
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            if series.dt.tz is None and not (series.dt.microsecond.any() or series.dt.nanosecond.any()):
+                converted = series.dt.strftime('%Y-%m-%dT%H:%M:%S')
+            else:
+                converted = series.map(lambda value: value.isoformat())
+        elif series.dtype == object:
+            converted = series.map(lambda value: value.isoformat() if isinstance(value, pd.Timestamp) else str(value))
+        else:
+            converted = series.astype(str)
+        values = converted.to_numpy(dtype=object)
+        values[na_mask[:, i]] = None
+        columns.append(values)
+    
+    keys = list(df.columns)
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+def _copy_data_entries(upload_id, sheet_name, records, start_index=0):
+    """
+    Load a batch of a sheet's rows with PostgreSQL COPY, inside the session's
+    transaction. Uses psycopg2's copy_expert, so callers must check the driver.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for index, row_dict in enumerate(records, start=start_index):
+        writer.writerow((upload_id, sheet_name, index, orjson.dumps(row_dict).decode()))
+    buffer.seek(0)
+    
+    cursor = db.session.connection().connection.cursor()
     try:
-        # Read Excel file
-        excel_file = pd.ExcelFile(filepath)
-        total_rows = 0
-        
+        cursor.copy_expert(
+            f"COPY {DataEntry.__tablename__} (upload_id, sheet_name, row_index, data_json) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+def _sheet_parquet(records):
+    """Serialize a sheet's converted rows to a zstd-compressed Parquet blob"""
+    buffer = io.BytesIO()
+    pd.DataFrame(records).to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+    return buffer.getvalue()
+
+def _resolve_columns(columns, *names):
+    """Resolve axis names against a sheet's columns: exact match first, then the
+    first case-insensitive match, using one lower-cased key map per sheet"""
+    key_map = {}
+    for col in columns:
+        key_map.setdefault(col.lower(), col)
+    exact = set(columns)
+    return [name if name in exact else key_map.get(name.lower()) for name in names]
+
+def upload_columns(upload_id):
+    """Column names in spreadsheet order, from the stats stored at parse time.
+    JSONB does not keep object key order, so the keys of stored rows can't be
+    relied on for it. Returns None for uploads without stored stats."""
+    stats_json = db.session.query(Upload.stats_json).filter(Upload.id == upload_id).scalar()
+    return orjson.loads(stats_json)['columns'] if stats_json else None
+
+def order_columns(columns, ordered):
+    """Sort columns by their position in ordered, keeping unknown ones last"""
+    if not ordered:
+        return list(columns)
+    rank = {col: i for i, col in enumerate(ordered)}
+    return sorted(columns, key=lambda col: rank.get(col, len(rank)))
+
+@lru_cache(maxsize=SHEET_CACHE_SIZE)
+def _sheet_tables(upload_id, filename):
+    """Decoded Parquet tables for an upload's sheets, cached per process so
+    repeat chart requests skip the database read. Keyed on the stored filename
+    as well, since SQLite can reuse a deleted upload's id."""
+    sheets = SheetData.query.filter_by(upload_id=upload_id).order_by(SheetData.id).all()
+    return tuple(pq.read_table(io.BytesIO(sheet.data_parquet)) for sheet in sheets)
+
+def _chart_frames(upload_id, x_axis, y_axis):
+    """(frame, x_col, y_col) per sheet, with the axis columns resolved once per
+    sheet. Frames come from the sheet's cached Parquet table projected to the
+    chart's columns, or are built from DataEntry rows grouped by sheet for
+    uploads parsed before sheets were stored as Parquet."""
+    upload = db.session.get(Upload, upload_id)
+    tables = _sheet_tables(upload_id, upload.filename) if upload else ()
+    if not tables:
+        entries = (db.session.query(DataEntry.sheet_name, DataEntry.data_json)
+                   .filter(DataEntry.upload_id == upload_id)
+                   .order_by(DataEntry.id))
+        frames = [pd.DataFrame([entry.data_json for entry in group if isinstance(entry.data_json, dict)])
+                  for _, group in groupby(entries, key=lambda entry: entry.sheet_name)]
+        return [(frame, *_resolve_columns(frame.columns, x_axis, y_axis)) for frame in frames]
+    
+    frames = []
+    for table in tables:
+        x_col, y_col = _resolve_columns(table.column_names, x_axis, y_axis)
+        columns = [col for col in dict.fromkeys([x_col, y_col]) if col]
+        if not columns:
+            # Neither column is in this sheet; keep its row count so they count as missing
+            frame = pd.DataFrame(index=range(table.num_rows))
+        else:
+            frame = table.select(columns).to_pandas()
+        frames.append((frame, x_col, y_col))
+    return frames
+
+def _prepare_sheet(df):
+    """Clean a sheet's column names and convert it to row dicts plus a Parquet
+    blob. Runs on worker threads, so it must not touch the database session."""
+    # Clean column names and handle unnamed columns in one vectorized pass
+    columns = df.columns.astype(str).str.strip()
+    # Only rename if truly unnamed (pandas auto-generated names)
+    unnamed = np.asarray(columns.str.startswith('Unnamed:') | columns.isin(['', 'nan', 'None']))
+    if unnamed.any():
+        # Try to use first row as header if it contains text
+        first_row = df.iloc[:1].astype(object).iloc[0]
+        first_text = first_row.astype(str).str.strip().to_numpy()
+        has_text = first_row.notna().to_numpy() & (first_text != '')
+        fallback = [f"Column_{i+1}" for i in range(len(columns))]
+        columns = np.where(unnamed, np.where(has_text, first_text, fallback), columns)
+    df.columns = list(columns)
+    
+    records = _sheet_records(df)
+    return records, _sheet_parquet(records)
+
+def _prepared_sheets(excel_file):
+    """Read and convert non-empty sheets, yielding (sheet_name, future) in sheet
+    order. Sheets are read lazily on this thread and converted on workers, with
+    at most PARSE_WORKERS sheets ahead of the caller, so a large workbook is
+    never held in memory at once. Sheets that fail to read are skipped."""
+    with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+        pending = deque()
         for sheet_name in excel_file.sheet_names:
+            # A sheet that fails to read is logged and skipped, like one that fails to convert
             try:
-                # Read sheet
-                df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                
-                # Skip empty sheets
-                if df.empty:
+                df = excel_file.parse(sheet_name)
+            except Exception as sheet_error:
+                logging.error(f"Error processing sheet {sheet_name}: {sheet_error}")
+                continue
+            if df.empty:
+                continue
+            pending.append((sheet_name, executor.submit(_prepare_sheet, df)))
+            # Drop the raw frame once it is handed to a worker
+            del df
+            if len(pending) > PARSE_WORKERS:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+def parse_excel_file(filepath, upload_id):
+    """Parse Excel file and store data in database"""
+    try:
+        # Open the workbook with the Rust-based calamine engine; sheets are read one at a time
+        with pd.ExcelFile(filepath, engine='calamine') as excel_file:
+            sheet_count = len(excel_file.sheet_names)
+            total_rows = 0
+            stats_builder = UploadStatsBuilder()
+            sample_rows = []
+            
+            # Clean and convert sheets in parallel; database writes stay on this thread
+            for sheet_name, future in _prepared_sheets(excel_file):
+                # A sheet that fails to clean is skipped; database errors below propagate
+                # so the whole upload is rolled back rather than committed partially
+                try:
+                    records, data_parquet = future.result()
+                except Exception as sheet_error:
+                    logging.error(f"Error processing sheet {sheet_name}: {sheet_error}")
                     continue
                 
-                # Clean column names and handle unnamed columns
-                df.columns = df.columns.astype(str)
-                cleaned_columns = []
-                for i, col in enumerate(df.columns):
-                    col = col.strip()
-                    # Only rename if truly unnamed (pandas auto-generated names)
-                    if col.startswith('Unnamed:') or col == '' or col == 'nan' or col == 'None':
-                        # Try to use first row as header if it contains text
-                        if len(df) > 0:
-                            first_row_val = df.iloc[0, i]
-                            if pd.notna(first_row_val) and str(first_row_val).strip():
-                                cleaned_columns.append(str(first_row_val).strip())
-                            else:
-                                cleaned_columns.append(f"Column_{i+1}")
-                        else:
-                            cleaned_columns.append(f"Column_{i+1}")
+                # Store records in bounded batches, with COPY for large sheets on PostgreSQL.
+                # copy_expert is psycopg2-only; other PostgreSQL drivers use bulk inserts.
+                use_copy = len(records) >= COPY_THRESHOLD and db.engine.dialect.driver == 'psycopg2'
+                for start in range(0, len(records), INSERT_BATCH_SIZE):
+                    batch = records[start:start + INSERT_BATCH_SIZE]
+                    if use_copy:
+                        _copy_data_entries(upload_id, sheet_name, batch, start_index=start)
                     else:
-                        # Keep the original column name
-                        cleaned_columns.append(col)
-                df.columns = cleaned_columns
+                        DataEntry.bulk_create(db.session, upload_id, batch, sheet_name=sheet_name, start_index=start)
                 
-                # Convert to records and store
-                for index, row in df.iterrows():
-                    # Convert row to dictionary, handling NaN values
-                    row_dict = {}
-                    for col, value in row.items():
-                        if pd.isna(value):
-                            row_dict[col] = None
-                        elif isinstance(value, (pd.Timestamp, pd.Timestamp)):
-                            row_dict[col] = value.isoformat()
-                        else:
-                            row_dict[col] = str(value)
-                    
-                    # Create data entry
-                    data_entry = DataEntry(
-                        upload_id=upload_id,
-                        sheet_name=sheet_name,
-                        row_index=index,
-                        data_json=json.dumps(row_dict)
-                    )
-                    db.session.add(data_entry)
-                    total_rows += 1
+                # Write the Parquet copy now instead of holding every sheet's blob until commit
+                db.session.add(SheetData(upload_id=upload_id, sheet_name=sheet_name, data_parquet=data_parquet))
+                db.session.flush()
                 
-            except Exception as sheet_error:
-                logging.error(f"Error processing sheet {sheet_name}: {sheet_error}")
-                continue
+                # Fold the sheet into the upload stats so no sheet is kept once stored
+                sample_rows.extend(records[:COLUMN_SAMPLE_ROWS - len(sample_rows)])
+                stats_builder.add(pd.DataFrame(records))
+                total_rows += len(records)
+        
+        # Store column stats now so AI insights and chart auto-selection don't rebuild them from rows
+        if total_rows:
+            upload = db.session.get(Upload, upload_id)
+            upload.stats_json = dump_upload_stats(stats_builder.result())
+            upload.column_stats = orjson.dumps(_column_stats(sample_rows)).decode()
         
         db.session.commit()
         
         if total_rows == 0:
             return False, "No valid data found in any sheets"
         
-        return True, f"Successfully parsed {total_rows} rows from {len(excel_file.sheet_names)} sheets"
+        return True, f"Successfully parsed {total_rows} rows from {sheet_count} sheets"
         
     except Exception as e:
         db.session.rollback()
         logging.error(f"Excel parsing error: {e}")
         return False, f"Failed to parse Excel file: {str(e)}"
 
+def _aggregate_chart_in_sql(upload_id, x_axis, y_axis, chart_type):
+    """
+    Build bar, pie and scatter chart data in PostgreSQL so only grouped rows (or a
+    capped set of points) leave the database. Returns None when the Python path
+    must run instead: other databases, other chart types, rows missing the
+    resolved column names, or no numeric rows.
+    """
+    if chart_type not in ('bar', 'pie', 'scatter') or db.engine.dialect.name != 'postgresql':
+        return None
+    
+    # Resolve case variants of the axis names against the stored column names
+    x_key, y_key = x_axis, y_axis
+    upload = db.session.get(Upload, upload_id)
+    if upload and upload.column_stats:
+        x_col, y_col = _resolve_columns(list(orjson.loads(upload.column_stats)), x_axis, y_axis)
+        x_key, y_key = x_col or x_axis, y_col or y_axis
+    
+    data = type_coerce(DataEntry.data_json, JSONB)
+    missing_key = (db.session.query(DataEntry.id)
+                   .filter(DataEntry.upload_id == upload_id,
+                           ~(data.has_key(x_key) & data.has_key(y_key)))
+                   .first())
+    if missing_key:
+        return None
+    
+    x_val = data[x_key].astext
+    y_text = func.replace(data[y_key].astext, ',', '')  # Remove commas from numbers
+    # Cast through numeric, which cannot overflow, and keep values float8 can hold
+    y_num = case((y_text.op('~')(SQL_NUMERIC_PATTERN), cast(y_text, Numeric)))
+    y_abs = func.abs(y_num)
+    y_val = cast(case((y_abs < literal(SQL_FLOAT_MIN, Numeric), 0), else_=y_num), Float)
+    valid = (DataEntry.upload_id == upload_id) & x_val.isnot(None) & (y_abs <= literal(SQL_FLOAT_MAX, Numeric))
+    
+    if chart_type in ('bar', 'pie'):
+        # Group by x and sum y values, sorted by value
+        total = func.sum(y_val)
+        rows = (db.session.query(x_val, total, func.count())
+                .filter(valid)
+                .group_by(x_val)
+                .order_by(total.desc(), x_val)
+                .all())
+        if not rows:
+            return None
+        labels = [row[0] for row in rows]
+        values = [row[1] for row in rows]
+        total_records = sum(row[2] for row in rows)
+        if chart_type == 'pie':
+            return _pie_chart(pd.DataFrame({'x': labels, 'y': values}), total_records, x_axis, y_axis)
+        return _bar_line_chart(chart_type, labels, values, total_records, x_axis, y_axis)
+    
+    rows = (db.session.query(x_val, y_val, func.count().over())
+            .filter(valid)
+            .order_by(DataEntry.id)
+            .limit(SCATTER_POINT_LIMIT)
+            .all())
+    if not rows:
+        return None
+    return _scatter_chart([{'x': row[0], 'y': row[1]} for row in rows], rows[0][2], x_axis, y_axis)
+
+def _pie_chart(grouped, total_records, x_axis, y_axis):
+    """Build the Chart.js config for a pie chart from x/y sums sorted by value"""
+    # Smart categorization: Group small slices into "Others"
+    total = grouped['y'].sum()
+    threshold = 0.03  # 3% threshold
+    
+    percentage = grouped['y'].to_numpy() / total if total > 0 else np.zeros(len(grouped))
+    keep = percentage >= threshold
+    keep[:5] = True  # Keep at least top 5
+    
+    labels = grouped['x'][keep].astype(str).tolist()
+    values = grouped['y'][keep].tolist()
+    
+    # Add "Others" category if needed
+    others_value = grouped['y'][~keep].sum()
+    if others_value > 0:
+        labels.append('Others')
+        values.append(others_value)
+    
+    # Calculate percentages for display
+    percentages = (np.asarray(values, dtype=float) / total * 100).tolist() if total > 0 else [0] * len(values)
+    
+    return {
+        'type': 'pie',
+        'data': {
+            'labels': labels,
+            'datasets': [{
+                'data': values,
+                'backgroundColor': list(MODERN_COLORS[:len(values)]),
+                'borderColor': list(BORDER_COLORS[:len(values)]),
+                'borderWidth': 2,
+                'hoverBorderWidth': 3,
+                'hoverBorderColor': '#fff',
+                'percentages': percentages
+            }]
+        },
+        'total_records': total_records,
+        'x_axis': x_axis,
+        'y_axis': y_axis
+    }
+
+def _bar_line_chart(chart_type, labels, values, total_records, x_axis, y_axis):
+    """Build the Chart.js config for a bar or line chart"""
+    # Modern colors for consistency
+    primary_color = '#6366F1'  # Modern indigo
+    
+    return {
+        'type': chart_type,
+        'data': {
+            'labels': labels,
+            'datasets': [{
+                'label': y_axis,
+                'data': values,
+                'backgroundColor': primary_color if chart_type == 'bar' else 'rgba(99, 102, 241, 0.1)',
+                'borderColor': primary_color,
+                'borderWidth': 2,
+                'fill': chart_type == 'line',
+                'tension': 0.3 if chart_type == 'line' else 0,  # Smooth line curves
+                'pointBackgroundColor': primary_color,
+                'pointBorderColor': '#fff',
+                'pointBorderWidth': 2,
+                'pointRadius': 4,
+                'pointHoverRadius': 6
+            }]
+        },
+        'total_records': total_records,
+        'x_axis': x_axis,
+        'y_axis': y_axis
+    }
+
+def _scatter_chart(points, total_records, x_axis, y_axis):
+    """Build the Chart.js config for a scatter chart"""
+    return {
+        'type': 'scatter',
+        'data': {
+            'datasets': [{
+                'label': f'{y_axis} vs {x_axis}',
+                'data': points,
+                'backgroundColor': 'rgba(236, 72, 153, 0.6)',  # Modern pink with transparency
+                'borderColor': '#EC4899',
+                'borderWidth': 1,
+                'pointRadius': 5,
+                'pointHoverRadius': 7,
+                'pointHoverBackgroundColor': '#EC4899',
+                'pointHoverBorderColor': '#fff',
+                'pointHoverBorderWidth': 2
+            }]
+        },
+        'total_records': total_records,
+        'x_axis': x_axis,
+        'y_axis': y_axis
+    }
+
 def generate_chart_data(upload_id, x_axis, y_axis, chart_type):
     """Generate chart data for visualization"""
     try:
@@ -96,139 +430,63 @@ def generate_chart_data(upload_id, x_axis, y_axis, chart_type):
         
         logging.info(f"Generating {chart_type} chart with X={x_axis}, Y={y_axis}")
         
-        # Get data entries
-        data_entries = DataEntry.query.filter_by(upload_id=upload_id).all()
+        # On PostgreSQL, let the database do the grouping
+        chart_data = _aggregate_chart_in_sql(upload_id, x_axis, y_axis, chart_type)
+        if chart_data is not None:
+            return chart_data
+        
+        # Get each sheet's data, projected to the chart's columns where possible
+        frames = _chart_frames(upload_id, x_axis, y_axis)
         
-        if not data_entries:
+        if not frames:
             raise ValueError("No data found for this upload")
         
-        # Parse data
-        data_rows = []
+        # Parse data one sheet at a time with vectorized conversions
+        parts = []
         missing_columns = set()
         non_numeric_count = 0
         
-        for entry in data_entries:
-            try:
-                row_data = json.loads(entry.data_json)
-                
-                # Check if columns exist (handle case variations)
-                # Try exact match first
-                x_col = x_axis if x_axis in row_data else None
-                y_col = y_axis if y_axis in row_data else None
-                
-                # If not found, try case-insensitive match
-                if not x_col:
-                    for key in row_data.keys():
-                        if key.lower() == x_axis.lower():
-                            x_col = key
-                            break
-                if not y_col:
-                    for key in row_data.keys():
-                        if key.lower() == y_axis.lower():
-                            y_col = key
-                            break
-                
-                if not x_col:
-                    missing_columns.add(x_axis)
-                    continue
-                if not y_col:
-                    missing_columns.add(y_axis)
-                    continue
-                    
-                x_val = row_data[x_col]
-                y_val = row_data[y_col]
-                
-                # Skip None values
-                if x_val is not None and y_val is not None:
-                    # For pie charts, x can be text, y must be numeric
-                    if chart_type == 'pie':
-                        try:
-                            y_val = float(str(y_val).replace(',', ''))  # Remove commas from numbers
-                            data_rows.append({'x': str(x_val), 'y': y_val})
-                        except (ValueError, TypeError):
-                            non_numeric_count += 1
-                            continue
-                    else:
-                        # For other charts, try to convert y_val to numeric
-                        try:
-                            y_val = float(str(y_val).replace(',', ''))  # Remove commas from numbers
-                        except (ValueError, TypeError):
-                            non_numeric_count += 1
-                            continue
-                        
-                        data_rows.append({'x': str(x_val), 'y': y_val})
-            except json.JSONDecodeError:
+        for frame, x_col, y_col in frames:
+            if len(frame) == 0:
+                continue
+            
+            if not x_col:
+                missing_columns.add(x_axis)
                 continue
+            if not y_col:
+                missing_columns.add(y_axis)
+                continue
+            
+            # Skip None values, then convert Y to numeric (removing commas from numbers)
+            present = frame[x_col].notna() & frame[y_col].notna()
+            y_vals = pd.to_numeric(frame.loc[present, y_col].astype(str).str.replace(',', '', regex=False),
+                                   errors='coerce')
+            # Infinities (from 'inf' or overflowing values like 1e400) count as non-numeric
+            numeric = y_vals.notna() & np.isfinite(y_vals.astype(float))
+            non_numeric_count += int((~numeric).sum())
+            
+            parts.append(pd.DataFrame({
+                'x': frame.loc[present, x_col][numeric].astype(str),
+                'y': y_vals[numeric].astype(float)
+            }))
         
         if missing_columns:
             raise ValueError(f"Column(s) not found: {', '.join(missing_columns)}")
-            
-        if not data_rows:
+        
+        # Create DataFrame for processing
+        df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['x', 'y'])
+        
+        if df.empty:
             if non_numeric_count > 0:
                 raise ValueError(f"The Y-axis column '{y_axis}' does not contain numeric data suitable for charting")
             else:
                 raise ValueError(f"No valid data found for columns {x_axis} and {y_axis}")
         
-        # Create DataFrame for processing
-        df = pd.DataFrame(data_rows)
-        
         if chart_type == 'pie':
             # For pie charts, group by x and sum y values
             grouped = df.groupby('x')['y'].sum().reset_index()
             grouped = grouped.sort_values('y', ascending=False)  # Sort by value
-            
-            # Smart categorization: Group small slices into "Others"
-            total = grouped['y'].sum()
-            threshold = 0.03  # 3% threshold
-            
-            main_data = []
-            others_value = 0
-            
-            for _, row in grouped.iterrows():
-                percentage = (row['y'] / total) if total > 0 else 0
-                if percentage >= threshold or len(main_data) < 5:  # Keep at least top 5
-                    main_data.append({'label': str(row['x']), 'value': row['y']})
-                else:
-                    others_value += row['y']
-            
-            # Add "Others" category if needed
-            if others_value > 0:
-                main_data.append({'label': 'Others', 'value': others_value})
-            
-            labels = [item['label'] for item in main_data]
-            values = [item['value'] for item in main_data]
-            
-            # Calculate percentages for display
-            percentages = [(v / total * 100) if total > 0 else 0 for v in values]
-            
-            # Modern color palette
-            modern_colors = [
-                '#6366F1', '#8B5CF6', '#EC4899', '#EF4444', '#F97316',
-                '#F59E0B', '#10B981', '#06B6D4', '#3B82F6', '#6B7280',
-                '#84CC16', '#F43F5E', '#8B5A2B', '#6366F1', '#14B8A6'
-            ]
-            
-            # Create gradient colors (darker shades for borders)
-            border_colors = [color.replace('#', '#aa') if not color.startswith('#aa') else color for color in modern_colors]
-            
-            return {
-                'type': 'pie',
-                'data': {
-                    'labels': labels,
-                    'datasets': [{
-                        'data': values,
-                        'backgroundColor': modern_colors[:len(values)],
-                        'borderColor': border_colors[:len(values)],
-                        'borderWidth': 2,
-                        'hoverBorderWidth': 3,
-                        'hoverBorderColor': '#fff',
-                        'percentages': percentages
-                    }]
-                },
-                'total_records': len(df),
-                'x_axis': x_axis,
-                'y_axis': y_axis
-            }
+            return _pie_chart(grouped, len(df), x_axis, y_axis)
         
         elif chart_type in ['bar', 'line']:
             # Group and aggregate data
@@ -240,57 +498,12 @@ def generate_chart_data(upload_id, x_axis, y_axis, chart_type):
                 # For line charts, keep original order
                 grouped = df.drop_duplicates(subset=['x']).sort_values('x')
             
-            labels = grouped['x'].tolist()
-            values = grouped['y'].tolist()
-            
-            # Modern colors for consistency
-            primary_color = '#6366F1'  # Modern indigo
-            
-            return {
-                'type': chart_type,
-                'data': {
-                    'labels': labels,
-                    'datasets': [{
-                        'label': y_axis,
-                        'data': values,
-                        'backgroundColor': primary_color if chart_type == 'bar' else 'rgba(99, 102, 241, 0.1)',
-                        'borderColor': primary_color,
-                        'borderWidth': 2,
-                        'fill': chart_type == 'line',
-                        'tension': 0.3 if chart_type == 'line' else 0,  # Smooth line curves
-                        'pointBackgroundColor': primary_color,
-                        'pointBorderColor': '#fff',
-                        'pointBorderWidth': 2,
-                        'pointRadius': 4,
-                        'pointHoverRadius': 6
-                    }]
-                },
-                'total_records': len(df),
-                'x_axis': x_axis,
-                'y_axis': y_axis
-            }
+            return _bar_line_chart(chart_type, grouped['x'].tolist(), grouped['y'].tolist(),
+                                   len(df), x_axis, y_axis)
         
         elif chart_type == 'scatter':
-            return {
-                'type': 'scatter',
-                'data': {
-                    'datasets': [{
-                        'label': f'{y_axis} vs {x_axis}',
-                        'data': [{'x': row['x'], 'y': row['y']} for row in data_rows],
-                        'backgroundColor': 'rgba(236, 72, 153, 0.6)',  # Modern pink with transparency
-                        'borderColor': '#EC4899',
-                        'borderWidth': 1,
-                        'pointRadius': 5,
-                        'pointHoverRadius': 7,
-                        'pointHoverBackgroundColor': '#EC4899',
-                        'pointHoverBorderColor': '#fff',
-                        'pointHoverBorderWidth': 2
-                    }]
-                },
-                'total_records': len(df),
-                'x_axis': x_axis,
-                'y_axis': y_axis
-            }
+            points = df.head(SCATTER_POINT_LIMIT).to_dict('records')
+            return _scatter_chart(points, len(df), x_axis, y_axis)
         
         else:
             raise ValueError(f"Unsupported chart type: {chart_type}")
@@ -299,43 +512,64 @@ def generate_chart_data(upload_id, x_axis, y_axis, chart_type):
         logging.error(f"Chart generation error: {e}")
         raise e
 
+def _column_stats(rows):
+    """Count numeric and text values per column over sample rows"""
+    rows = [row for row in rows if isinstance(row, dict)]
+    if not rows:
+        return {}
+    
+    # Rows from different sheets can have different keys, so count key presence directly
+    totals = Counter(col for row in rows for col in row)
+    values = pd.DataFrame(rows).astype(object)
+    text = values.astype(str)
+    
+    # Non-empty values, then those that convert to numbers (handling commas) in one pass per column
+    filled = values.notna() & text.apply(lambda col: col.str.strip() != '')
+    numeric = filled & text.apply(lambda col: pd.to_numeric(col.str.replace(',', '', regex=False),
+                                                            errors='coerce').notna())
+    numeric_counts = numeric.sum()
+    text_counts = (filled & ~numeric).sum()
+    
+    return {
+        col: {
+            'numeric': int(numeric_counts[col]),
+            'text': int(text_counts[col]),
+            'total': totals[col],
+            'sample_values': text[col][filled[col]].head(5).tolist()
+        }
+        for col in values.columns
+    }
+
 def auto_select_columns(upload_id, chart_type):
     """Automatically select best columns for the given chart type"""
     try:
-        # Get data entries
-        data_entries = DataEntry.query.filter_by(upload_id=upload_id).limit(100).all()
+        # Column type counts are stored at parse time; older uploads sample their rows here
+        upload = db.session.get(Upload, upload_id)
+        if upload and upload.column_stats:
+            columns_info = orjson.loads(upload.column_stats)
+        else:
+            # Fetch only the JSON column of the sampled rows, as lightweight Row tuples
+            entries = (db.session.query(DataEntry.data_json)
+                       .filter(DataEntry.upload_id == upload_id)
+                       .order_by(DataEntry.id)
+                       .limit(COLUMN_SAMPLE_ROWS)
+                       .all())
+            columns_info = _column_stats(entry.data_json for entry in entries)
+            # Keep spreadsheet order so the first text/numeric column is the same on JSONB
+            columns_info = {col: columns_info[col] for col in order_columns(columns_info, upload_columns(upload_id))}
+            
+            # Save them so later calls for this upload skip the row scan
+            if upload and columns_info:
+                try:
+                    upload.column_stats = orjson.dumps(columns_info).decode()
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Column stats save error: {e}")
         
-        if not data_entries:
+        if not columns_info:
             return None, None
         
-        # Parse first few rows to understand data structure
-        data_rows = []
-        columns_info = {}
-        
-        for entry in data_entries[:20]:  # Sample first 20 rows
-            try:
-                row_data = json.loads(entry.data_json)
-                data_rows.append(row_data)
-                
-                # Analyze column types
-                for col, value in row_data.items():
-                    if col not in columns_info:
-                        columns_info[col] = {'numeric': 0, 'text': 0, 'total': 0, 'sample_values': []}
-                    
-                    columns_info[col]['total'] += 1
-                    if value is not None and str(value).strip() != '':
-                        try:
-                            # Try to convert to float, handling commas in numbers
-                            float(str(value).replace(',', ''))
-                            columns_info[col]['numeric'] += 1
-                        except (ValueError, TypeError):
-                            columns_info[col]['text'] += 1
-                        
-                        if len(columns_info[col]['sample_values']) < 5:
-                            columns_info[col]['sample_values'].append(str(value))
-            except json.JSONDecodeError:
-                continue
-        
         # Identify numeric and text columns
         numeric_columns = []
         text_columns = []
@@ -422,12 +656,12 @@ def format_file_size(size_bytes):
         return "0 B"
     
     size_names = ["B", "KB", "MB", "GB"]
-    import math
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
+    # Each unit is 2**10 of the previous one, so the bit length picks the unit
+    i = min((int(size_bytes).bit_length() - 1) // 10, len(size_names) - 1)
+    s = round(size_bytes / (1 << (10 * i)), 2)
     return f"{s} {size_names[i]}"
 
-# Add the format_file_size function to Jinja2 global functions
-from app import app
-app.jinja_env.globals.update(format_file_size=format_file_size)
+def init_app(app):
+    """Register template helpers on the Flask app"""
+    # Add the format_file_size function to Jinja2 global functions
+    app.jinja_env.globals.update(format_file_size=format_file_size)